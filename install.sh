@@ -37,6 +37,7 @@ OUT_FILE=$PH_ETC/pihole-autoblocker.txt
 LEGACY_SYMLINK=$PH_ETC/custom_autoblocker.txt
 REVIEW_JSON=$VAR/quarantine_review.json
 QUAR_JSON=$VAR/quarantine.json
+QUAR_DB=$VAR/quarantine.db
 TSV=$VAR/quarantine.tsv
 FTL_DB=$PH_ETC/pihole-FTL.db
 
@@ -130,14 +131,18 @@ cname_max_depth: 2
 cname_cache_only: true
 cname_cache_ttl_hours: 24
 cname_cache_path: $VAR/cname_cache.json
+cname_workers: 32              # concurrent lookups against the local resolver
+cname_concurrency: 64          # in-flight queries when python3-aiodns is installed
 
 # --- Reputation by family (eTLD+1 overlaps across adlists) ---
 family_adlist_threshold: 6
+fams_cache_path: $VAR/fams_cache.marshal   # reused until gravity.db changes
 
 # --- Files/paths ---
 output_file: $OUT_FILE
 legacy_output_symlink: $LEGACY_SYMLINK
-quarantine_file: $QUAR_JSON
+quarantine_file: $QUAR_JSON          # legacy; imported into quarantine_db on first run
+quarantine_db: $QUAR_DB
 quarantine_review_file: $REVIEW_JSON
 quarantine_tsv_file: $TSV
 ftl_db: $FTL_DB
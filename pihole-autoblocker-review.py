@@ -4,7 +4,7 @@ Interactive reviewer for Pi-hole Autoblocker quarantine.
 
 Features
 - Reads /etc/pihole-autoblocker/config.yml
-- Loads JSON review (sorted) or falls back to quarantine.json and converts
+- Loads JSON review (sorted); falls back to the quarantine DB (quarantine.db), then legacy quarantine.json
 - Lists candidates with score/reason/hits/uniq/hours
 - Selection options: indexes, ranges (e.g., 0 1 5-10), regex filter, or fzf if installed
 - Actions: promote to manual blocklist (default) or release to allowlist
@@ -32,27 +32,49 @@ Requirements
 - jq/fzf NOT required (optional for --fzf mode only)
 """
 from __future__ import annotations
-import argparse, json, os, re, subprocess, sys
+import argparse, heapq, json, os, re, sys
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
 from typing import List, Dict, Any
 
 try:
-    import yaml
+    import orjson  # optional: faster loading of large review files
 except ImportError:
-    print("python3-yaml is required. Install: sudo apt-get install -y python3-yaml", file=sys.stderr)
-    sys.exit(1)
+    orjson = None
 
 CONFIG_PATH = "/etc/pihole-autoblocker/config.yml"
 
+# Selection tokens (each whitespace-separated token must match whole): /regex/, a-b range, or single index
+TOKEN_RE = re.compile(r"/(.+)/|(\d+)-(\d+)|(\d+)")
+
 # ---------- helpers ----------
 
+@lru_cache(maxsize=1)
 def load_cfg(path: str = CONFIG_PATH) -> dict:
+    # Heavy imports are deferred to the paths that need them (keeps --help snappy)
+    try:
+        import yaml
+    except ImportError:
+        print("python3-yaml is required. Install: sudo apt-get install -y python3-yaml", file=sys.stderr)
+        sys.exit(1)
+    try:
+        from yaml import CSafeLoader as YamlLoader  # libyaml C parser
+    except ImportError:
+        from yaml import SafeLoader as YamlLoader
     with open(path, "r") as f:
-        return yaml.safe_load(f) or {}
+        data = yaml.load(f, Loader=YamlLoader)
+    return data or {}
+
+def load_json_file(p: Path):
+    data = p.read_bytes()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
 
 def derive_paths(cfg: dict) -> dict:
     # Main quarantine dict file (legacy structure)
     qfile = cfg.get("quarantine_file") or "/var/lib/pihole-autoblocker/quarantine.json"
+    # Authoritative quarantine store (sqlite)
+    qdb = cfg.get("quarantine_db") or str(Path(qfile).with_suffix(".db"))
     # Preferred sorted review array
     review = cfg.get("quarantine_review_file")
     if not review:
@@ -62,30 +84,48 @@ def derive_paths(cfg: dict) -> dict:
     out = {
         "review": review,
         "qfile": qfile,
+        "qdb": qdb,
         "manual": cfg.get("manual_block_file", "/etc/pihole/pihole-autoblocker.manual-block.txt"),
         "allow": cfg.get("allowlist_file", "/etc/pihole/pihole-autoblocker.allow.txt"),
         "log": cfg.get("log_file", "/var/log/pihole-autoblocker.log"),
         "service": cfg.get("systemd_unit", "pihole-autoblocker.service"),
         "promo_comment": cfg.get("promotion_comment", "autoblocker"),
+        "promo_group": cfg.get("promotion_group", "Default"),
         "sql_promotion": bool(cfg.get("sql_promotion", False)),
     }
     return out
 
 
-def load_review(paths: dict) -> List[Dict[str, Any]]:
+def load_review(paths: dict, limit: int | None = None) -> List[Dict[str, Any]]:
+    """Review items sorted by score (descending); only the top `limit` when given."""
     rp = Path(paths["review"])  # array sorted by score
     if rp.exists():
         try:
-            data = json.loads(rp.read_text())
+            data = load_json_file(rp)
             if isinstance(data, list):
-                return data
+                return data if limit is None else data[:limit]
         except Exception:
             pass
-    # fall back: convert dict to array
+    # fall back: read the quarantine DB, already sorted by score
+    qdb = Path(paths["qdb"])
+    if qdb.exists():
+        try:
+            import sqlite3
+            conn = sqlite3.connect(f"file:{qdb}?mode=ro", uri=True)
+            cols = ("domain", "score", "reason", "first_seen", "last_seen", "hits", "uniq", "hours")
+            rows = conn.execute(
+                f"SELECT {', '.join(cols)} FROM q ORDER BY score DESC LIMIT ?",
+                (-1 if limit is None else limit,),
+            ).fetchall()
+            conn.close()
+            return [dict(zip(cols, r)) for r in rows]
+        except Exception:
+            pass
+    # legacy: convert dict to array
     qp = Path(paths["qfile"])  # dict keyed by domain
     if qp.exists():
         try:
-            raw = json.loads(qp.read_text())
+            raw = load_json_file(qp)
             if isinstance(raw, dict):
                 items = []
                 for d, v in raw.items():
@@ -99,7 +139,9 @@ def load_review(paths: dict) -> List[Dict[str, Any]]:
                         "uniq": int(v.get("uniq", 0)),
                         "hours": int(v.get("hours", 0)),
                     })
-                items.sort(key=lambda x: x.get("score", 0.0), reverse=True)
+                if limit is not None:
+                    return heapq.nlargest(limit, items, key=itemgetter("score"))
+                items.sort(key=itemgetter("score"), reverse=True)
                 return items
         except Exception:
             pass
@@ -107,21 +149,25 @@ def load_review(paths: dict) -> List[Dict[str, Any]]:
 
 
 def print_table(items: List[Dict[str, Any]], limit: int | None = None):
-    from math import ceil
     rows = items if limit is None else items[:limit]
-    print(f"idx  score   hits uniq hrs   domain                                 reason")
-    print("-"*100)
-    for i, it in enumerate(rows):
-        score = f"{float(it.get('score',0.0)):.3f}"
-        hits = str(it.get('hits',0))
-        uniq = str(it.get('uniq',0))
-        hrs  = str(it.get('hours',0))
-        dom = it.get('domain','')[:35]
-        rsn = it.get('reason','')[:40]
-        print(f"{i:>3}  {score:>6}  {hits:>4} {uniq:>4} {hrs:>3}   {dom:<35}  {rsn}")
+    out = [
+        f"idx  score   hits uniq hrs   domain                                 reason",
+        "-"*100,
+    ]
+    cols = (
+        (float(it.get('score',0.0)), str(it.get('hits',0)), str(it.get('uniq',0)), str(it.get('hours',0)),
+         it.get('domain','')[:35], it.get('reason','')[:40])
+        for it in rows
+    )
+    out.extend(
+        f"{i:>3}  {score:>6.3f}  {hits:>4} {uniq:>4} {hrs:>3}   {dom:<35}  {rsn}"
+        for i, (score, hits, uniq, hrs, dom, rsn) in enumerate(cols)
+    )
+    sys.stdout.write("\n".join(out) + "\n")
 
 
 def has_fzf() -> bool:
+    import shutil
     return shutil.which("fzf") is not None
 
 
@@ -133,25 +179,28 @@ def choose_indices(items: List[Dict[str, Any]]) -> List[int]:
     if not s:
         return []
     sel: List[int] = []
-    tokens = s.split()
-    for t in tokens:
-        if t.startswith("/") and t.endswith("/"):
-            pat = re.compile(t[1:-1])
-            for idx, it in enumerate(items):
-                if pat.search(it.get("domain","")):
-                    sel.append(idx)
-        elif "-" in t:
-            a,b = t.split("-",1)
+    parts: List[str] = []
+    for tok in s.split():
+        m = TOKEN_RE.fullmatch(tok)
+        if m is None:
+            print(f"Ignoring unrecognized token: {tok}")
+            continue
+        rx, a, b, n = m.groups()
+        if rx is not None:
             try:
-                a=int(a); b=int(b)
-                sel.extend(list(range(min(a,b), max(a,b)+1)))
-            except ValueError:
-                pass
+                re.compile(rx)
+            except re.error as e:
+                print(f"Ignoring invalid regex {tok}: {e}")
+                continue
+            parts.append(rx)
+        elif n is not None:
+            sel.append(int(n))
         else:
-            try:
-                sel.append(int(t))
-            except ValueError:
-                pass
+            a=int(a); b=int(b)
+            sel.extend(range(min(a,b), max(a,b)+1))
+    if parts:
+        combined = re.compile("|".join(f"(?:{p})" for p in parts))
+        sel.extend(idx for idx, it in enumerate(items) if combined.search(it.get("domain","")))
     sel = [i for i in sorted(set(sel)) if 0 <= i < len(items)]
     return sel
 
@@ -180,30 +229,51 @@ def choose_with_fzf(items: List[Dict[str, Any]]) -> List[int]:
 def write_lines(path: str, domains: List[str]):
     p = Path(path)
     p.parent.mkdir(parents=True, exist_ok=True)
-    with open(p, "a") as f:
-        for d in domains:
-            f.write(d.strip()+"\n")
+    with open(p, "a", buffering=1 << 16) as f:
+        f.write("".join(d.strip()+"\n" for d in domains))
+
 
+def promote_sql(domains: List[str], comment: str, group_name: str = "Default") -> int:
+    """Blacklist all domains in one transaction (same upsert as the scanner); returns rows changed.
 
-def promote_sql(domains: List[str], comment: str) -> int:
-    ok = 0
-    for d in domains:
+    Existing disabled entries are re-enabled. Nothing is written if the group does not exist.
+    """
+    import sqlite3, subprocess
+    try:
+        conn = sqlite3.connect("/etc/pihole/gravity.db")
+        row = conn.execute("SELECT id FROM 'group' WHERE name=? AND enabled=1;", (group_name,)).fetchone()
+        if not row:
+            conn.close()
+            return 0
+        gid = row[0]
+        conn.execute("BEGIN IMMEDIATE")  # take the write lock before the batch, not halfway through
+        with conn:
+            # rowcount, not total_changes: the latter also counts rows written by gravity.db triggers
+            changed = conn.executemany(
+                "INSERT INTO domainlist (type,domain,enabled,comment,date_added,date_modified) "
+                "VALUES (1,?,1,?,strftime('%s','now'),strftime('%s','now')) "
+                "ON CONFLICT(domain,type) DO UPDATE SET enabled=1, date_modified=strftime('%s','now') "
+                "WHERE enabled=0",
+                [(d, comment) for d in domains],
+            ).rowcount
+            conn.executemany(
+                "INSERT OR IGNORE INTO domainlist_by_group (domainlist_id,group_id) "
+                "SELECT id, ? FROM domainlist WHERE domain=? AND type=1",
+                [(gid, d) for d in domains],
+            )
+        conn.close()
+    except Exception:
+        return 0
+    if changed:
         try:
-            subprocess.run([
-                "sqlite3","/etc/pihole/gravity.db",
-                "INSERT INTO domainlist (type,domain,enabled,comment,date_added,date_modified) VALUES (1,?,1,?,strftime('%s','now'),strftime('%s','now'));",
-                ], input=f"{d}\n{comment}\n", text=True, check=False, capture_output=True)
-            ok += 1
+            subprocess.run(["pihole","restartdns","reload-lists"], check=False)
         except Exception:
             pass
-    try:
-        subprocess.run(["pihole","restartdns","reload-lists"], check=False)
-    except Exception:
-        pass
-    return ok
+    return changed
 
 
 def trigger_service(unit: str):
+    import subprocess
     try:
         subprocess.run(["systemctl","start", unit], check=False)
     except Exception:
@@ -222,12 +292,13 @@ def main():
 
     cfg = load_cfg()
     paths = derive_paths(cfg)
-    items = load_review(paths)
 
     if args.top:
-        print_table(items, limit=args.top)
+        print_table(load_review(paths, limit=args.top))
         return
 
+    items = load_review(paths)
+
     if args.release:
         domains = [d.strip() for d in Path(args.release).read_text().splitlines() if d.strip()]
         write_lines(paths["allow"], domains)
@@ -262,7 +333,7 @@ def main():
     write_lines(paths["manual"], targets)
     inserted = 0
     if paths["sql_promotion"]:
-        inserted = promote_sql(targets, paths["promo_comment"])
+        inserted = promote_sql(targets, paths["promo_comment"], paths["promo_group"])
 
     trigger_service(paths["service"])  # will regenerate output list
 
@@ -10,69 +10,276 @@ Update highlights in v1.0:
 Config: /etc/pihole-autoblocker/config.yml
 """
 
-import json, os, time, subprocess, sqlite3, sys
+import asyncio, hashlib, heapq, json, marshal, mmap, os, pickle, re, time, subprocess, sqlite3, sys
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 
 # ---- Dependencies ----
 try:
     import yaml
 except ImportError:
     raise SystemExit("Missing dependency: python3-yaml. Install with: sudo apt-get install -y python3-yaml")
+try:
+    from yaml import CSafeLoader as YamlLoader   # libyaml C parser
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    import orjson             # optional (python3-orjson): faster state/cache (de)serialization
+except ImportError:
+    orjson = None
+
+try:
+    import dns.resolver       # optional (python3-dnspython): avoids a dig subprocess per lookup
+except ImportError:
+    dns = None
+
+try:
+    import aiodns             # optional (python3-aiodns): concurrent CNAME lookups on one event loop
+    import pycares
+except ImportError:
+    aiodns = None
+
+try:
+    import ahocorasick        # optional (pyahocorasick): one-pass multi-substring scan
+except ImportError:
+    ahocorasick = None
+
+# ---- Config ----
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+_COERCE = {int: int, float: float, bool: bool, tuple: tuple}
+
+def _norm_suffixes(lst) -> frozenset:
+    return frozenset({(s or "").lower().strip().lstrip('*.') for s in lst} - {""})
+
+@dataclass(frozen=True, **_SLOTS)
+class Cfg:
+    """Typed view of config.yml, coerced once at load (unknown keys are ignored)."""
+    # Traffic gating
+    lookback_hours: int = 24
+    min_hits: int = 10
+    min_unique_clients: int = 2
+    min_hours_active: int = 0
+    # Quarantine & promotion
+    quarantine_hours: int = 12
+    promotion_min_score: float = 0.90
+    dry_run: bool = False
+    sql_promotion: bool = False
+    promotion_group: str = "Default"
+    promotion_comment: str = "autoblocker"
+    # Heuristics
+    allowlist: tuple = ()
+    suspicious_substrings: tuple = ()
+    suspicious_tlds: tuple = ()
+    auto_learn_keywords: bool = False
+    learned_keywords_path: Optional[str] = None
+    learn_refresh_hours: int = 24
+    learn_min_support_etlds: int = 8
+    learn_max_keywords: int = 200
+    learn_stopwords: tuple = ()
+    family_adlist_threshold: int = 0
+    fams_cache_path: Optional[str] = None
+    # CNAME checks
+    cname_max_depth: int = 0
+    cname_cache_only: bool = False
+    cname_cache_ttl_hours: int = 24
+    cname_cache_path: Optional[str] = None
+    cname_workers: int = 32
+    cname_concurrency: int = 64
+    top_n_cname: int = 200
+    # Scoring
+    score_hits_k: float = 20.0
+    score_uniq_k: float = 3.0
+    score_hours_k: float = 6.0
+    # Files/paths
+    ftl_db: Optional[str] = None
+    quarantine_file: str = "/var/lib/pihole-autoblocker/quarantine.json"
+    quarantine_db: Optional[str] = None
+    quarantine_review_file: Optional[str] = None
+    quarantine_tsv_file: Optional[str] = None
+    state_file: str = "/var/lib/pihole-autoblocker/state.json"
+    log_file: str = "/var/log/pihole-autoblocker.log"
+    metrics_path: Optional[str] = None
+    output_file: str = "/etc/pihole/pihole-autoblocker.txt"
+    legacy_output_symlink: Optional[str] = None
+    allowlist_file: str = "/etc/pihole/pihole-autoblocker.allow.txt"
+    manual_block_file: str = "/etc/pihole/pihole-autoblocker.manual-block.txt"
+    # Derived: normalized suffix sets for domain_suffix_in_set
+    allow_suffixes: frozenset = field(init=False, default=frozenset())
+    tld_suffixes: frozenset = field(init=False, default=frozenset())
+
+    def __post_init__(self):
+        object.__setattr__(self, "allow_suffixes", _norm_suffixes(self.allowlist))
+        object.__setattr__(self, "tld_suffixes", _norm_suffixes(self.suspicious_tlds))
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "Cfg":
+        raw = raw or {}
+        kw = {}
+        for f in fields(cls):
+            if not f.init:
+                continue
+            v = raw.get(f.name)
+            if v is None:
+                continue
+            kw[f.name] = _COERCE.get(type(f.default), str)(v)
+        return cls(**kw)
 
 # ---- Globals populated at runtime ----
-CFG = {}
-LEARNED = set()           # auto-learned keywords from adlists
-FAMS = set()              # eTLD+1 families with high adlist overlap
+CFG = Cfg()
+LEARNED = frozenset()     # auto-learned keywords from adlists
+FAMS = frozenset()        # eTLD+1 families with high adlist overlap
 CNAME_CACHE = {}          # in-run cache
 CNAME_PERSIST = {}        # persistent cache with TTL
+RESOLVER = None           # dnspython resolver against the local FTL (if available)
+HEUR_MATCH = None         # compiled suspicious_substrings + LEARNED matcher
 
 # ---- Utils ----
+@lru_cache(maxsize=1)
 def load_yaml(p):
+    """Parse config once; reuse a pickled copy while the YAML's (mtime, size) is exactly the one it was built from."""
+    src = Path(p)
+    cache = src.with_suffix(".pkl")
+    try:
+        st = src.stat()
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    try:
+        with open(cache, 'rb') as f:
+            cached = pickle.load(f)
+        # exact match: a config restored with an older mtime (cp -p, rsync -t, tar) must not reuse it
+        if key is not None and cached.get("key") == key:
+            return cached["data"]
+    except Exception:
+        pass
     with open(p, 'r') as f:
-        return yaml.safe_load(f)
+        data = yaml.load(f, Loader=YamlLoader)
+    try:
+        with open(cache, 'wb') as f:
+            pickle.dump({"key": key, "data": data}, f)
+    except Exception:
+        pass
+    return data
 
 def now_ts():
     return int(time.time())
 
-def domain_suffix_in_list(domain: str, suffixes: list[str]) -> bool:
-    d = domain.lower().rstrip('.')
-    for s in suffixes or []:
-        s = (s or "").lower().strip().lstrip('*')
-        if not s:
-            continue
-        if d == s or d.endswith("." + s) or d.endswith(s):
+def etld1_fast(d: str) -> str:
+    """Last two labels of an already lowercased/stripped name, without split/join."""
+    a, _, c = d.rpartition('.')
+    if not a:
+        return c
+    _, _, b = a.rpartition('.')
+    return b + '.' + c
+
+def domain_suffix_in_set(d: str, suffixes: frozenset) -> bool:
+    """True if d (lowercased, no trailing dot) or any parent of it is in the pre-normalized
+    suffix set (see Cfg.allow_suffixes / Cfg.tld_suffixes); one lookup per label."""
+    if not suffixes:
+        return False
+    while d:
+        if d in suffixes:
             return True
+        d = d.partition('.')[2]
     return False
 
 def log(path: str, msg: str):
+    log_lines(path, [msg])
+
+def log_lines(path: str, msgs: list[str]):
+    """Append messages with one timestamp in a single buffered write."""
+    if not msgs:
+        return
     ts = datetime.now().isoformat(timespec='seconds')
     Path(path).parent.mkdir(parents=True, exist_ok=True)
-    with open(path, 'a') as f:
-        f.write(f"[{ts}] {msg}\n")
+    with open(path, 'a', buffering=1 << 16) as f:
+        f.write("".join(f"[{ts}] {m}\n" for m in msgs))
 
 def load_json(path: str, default):
     p = Path(path)
     if not p.exists():
         return default
     try:
-        return json.loads(p.read_text())
+        data = p.read_bytes()
+        return orjson.loads(data) if orjson is not None else json.loads(data)
     except Exception:
         return default
 
 def save_json(path: str, obj):
+    """Compact JSON for internal state and caches."""
     Path(path).parent.mkdir(parents=True, exist_ok=True)
-    Path(path).write_text(json.dumps(obj, indent=2, sort_keys=True))
+    if orjson is not None:
+        data = orjson.dumps(obj)
+    else:
+        data = json.dumps(obj, separators=(",", ":")).encode()
+    Path(path).write_bytes(data)
 
 # ---- Pi-hole DB access ----
-def get_recent_counts_from_ftl(ftl_db: str, lookback_hours: int):
+GRAVITY_DB = "/etc/pihole/gravity.db"
+# Every connection: 16 MiB page cache, mmap'd reads, in-memory temp b-trees
+BASE_PRAGMAS = ("cache_size=-16000", "mmap_size=268435456", "temp_store=MEMORY")
+# The FTL aggregate scans the whole lookback window: map up to 1 GiB, 64 MiB cache.
+FTL_PRAGMAS = ("mmap_size=1073741824", "cache_size=-65536")
+
+def open_db(path: str, readonly: bool = True, pragmas=()):
+    """Open a connection once per run; helpers below receive it instead of reconnecting."""
+    try:
+        if readonly:
+            conn = sqlite3.connect(f"{Path(path).absolute().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(path, check_same_thread=False)
+        conn.executescript("".join(
+            f"PRAGMA {p};" for p in (*BASE_PRAGMAS, f"query_only={int(readonly)}", *pragmas)
+        ))
+        return conn
+    except Exception:
+        return None
+
+def db_mtime_ns(path: str) -> int:
+    """Last-write stamp of a sqlite DB, counting its WAL (commits may not touch the main file yet)."""
+    m = 0
+    for p in (path, path + "-wal"):
+        try:
+            m = max(m, os.stat(p).st_mtime_ns)
+        except OSError:
+            pass
+    return m
+
+def attach_gravity(conn, path: str = GRAVITY_DB) -> bool:
+    """ATTACH gravity.db (read-only) as `g` so FTL queries can filter blocked domains in SQL."""
+    try:
+        conn.execute("ATTACH DATABASE ? AS g", (f"{Path(path).absolute().as_uri()}?mode=ro",))
+        return True
+    except Exception:
+        return False
+
+# Exact blacklist/adlist hits; regex entries are still matched in Python (is_blocked)
+_NOT_BLOCKED_SQL = """
+              AND NOT EXISTS (SELECT 1 FROM g.gravity WHERE g.gravity.domain = queries.domain)
+              AND NOT EXISTS (SELECT 1 FROM g.domainlist WHERE g.domainlist.domain = queries.domain
+                              AND type IN (1,3) AND enabled = 1)"""
+
+def get_ftl_stats(conn, lookback_hours: int, min_hits: int, min_unique: int, min_hours: int = 0,
+                  exclude_blocked: bool = False):
+    """Return [(domain, hits, uniq, hours)] for domains meeting the traffic thresholds, in one pass.
+
+    With exclude_blocked (gravity attached as `g`), domains already blocked exactly are dropped too.
+    None means FTL could not be queried; [] is a valid answer (nothing over the thresholds).
+    """
+    if conn is None:
+        return None
     try:
-        conn = sqlite3.connect(ftl_db)
-        cur = conn.cursor()
         since = int(time.time()) - lookback_hours * 3600
-        cur.execute(
-            """
-            SELECT domain, COUNT(*) AS hits, COUNT(DISTINCT client) AS uniq
+        rows = conn.execute(
+            f"""
+            SELECT domain, COUNT(*) AS hits, COUNT(DISTINCT client) AS uniq,
+                   COUNT(DISTINCT CAST(timestamp / 3600 AS INTEGER)) AS hrs
             FROM queries
             WHERE timestamp >= ?
               AND domain NOT NULL
@@ -80,140 +287,341 @@ def get_recent_counts_from_ftl(ftl_db: str, lookback_hours: int):
               AND domain NOT LIKE '%.in-addr.arpa'
               AND domain NOT LIKE '%.ip6.arpa'
             GROUP BY domain
+            HAVING hits >= ? AND uniq >= ? AND hrs >= ?{_NOT_BLOCKED_SQL if exclude_blocked else ""}
             """,
-            (since,),
-        )
-        rows = cur.fetchall()
-        conn.close()
-        return {d: {"hits": h, "uniq": u} for d, h, u in rows}
+            (since, min_hits, min_unique, min_hours),
+        ).fetchall()
+        return rows
     except Exception:
-        return {}
+        return None
+
+# "... dnsmasq[pid]: query[A] example.com from 10.0.0.1"
+LOG_QUERY_RE = re.compile(rb" query\[[^\]]+\] (\S+) from (\S+)")
 
-def fallback_counts_from_log(lookback_hours: int):
+def fallback_counts_from_log(lookback_hours: int, min_hits: int, min_unique: int):
     path = "/var/log/pihole/pihole.log"
     if not os.path.exists(path):
-        return {}
-    counts = {}
+        return []
+    hits = Counter()
+    clients = defaultdict(set)   # domain -> {client}
     try:
-        with open(path, 'r', errors='ignore') as f:
-            for line in f:
-                if " query[" not in line or " from " not in line:
-                    continue
-                parts = line.strip().split()
-                try:
-                    dom = parts[5]; cli = parts[7]
-                except Exception:
-                    continue
-                d = counts.get(dom, {"hits": 0, "clients": set()})
-                d["hits"] += 1
-                d["clients"].add(cli)
-                counts[dom] = d
-        return {k: {"hits": v["hits"], "uniq": len(v["clients"]) } for k, v in counts.items()}
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for m in LOG_QUERY_RE.finditer(mm):
+                dom, cli = m.groups()
+                hits[dom] += 1
+                clients[dom].add(cli)
+        # the log carries no per-hour breakdown here, so hours stays 0
+        return [
+            (dom.decode(errors='ignore'), h, len(clients[dom]), 0)
+            for dom, h in hits.items()
+            if h >= min_hits and len(clients[dom]) >= min_unique
+        ]
     except Exception:
-        return {}
+        return []
 
-def is_already_blocked_anywhere(domain: str) -> bool:
-    """True if blocked by local blacklist (domainlist) or by adlists (gravity)."""
+def already_blocked_set(conn, domains) -> set:
+    """Subset of domains blocked by local blacklist (domainlist) or by adlists (gravity), in one query."""
+    if not domains:
+        return set()
     try:
-        conn = sqlite3.connect("/etc/pihole/gravity.db")
-        cur = conn.cursor()
-        # local blacklist
-        cur.execute(
-            "SELECT 1 FROM domainlist WHERE domain = ? AND type IN (1,3) AND enabled = 1 LIMIT 1",
-            (domain,),
-        )
-        if cur.fetchone() is not None:
-            conn.close(); return True
-        # adlists (gravity)
-        cur.execute("SELECT 1 FROM gravity WHERE domain = ? LIMIT 1", (domain,))
-        hit = cur.fetchone() is not None
-        conn.close(); return hit
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS cand(d TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM cand")
+        conn.executemany("INSERT OR IGNORE INTO cand VALUES (?)", ((d,) for d in domains))
+        rows = conn.execute(
+            """
+            SELECT d FROM cand
+            WHERE EXISTS (SELECT 1 FROM domainlist WHERE domain = cand.d AND type IN (1,3) AND enabled = 1)
+               OR EXISTS (SELECT 1 FROM gravity WHERE domain = cand.d)
+            """
+        ).fetchall()
+        conn.commit()  # don't hold gravity.db locks for the rest of the run
+        return {r[0] for r in rows}
     except Exception:
-        return False
+        return set()
+
+# Leading inline flags such as "(?i)" are only legal at the start of a whole pattern
+_INLINE_FLAGS_RE = re.compile(r"\(\?([aiLmsux]+)\)")
+
+def _scoped_regex(rx: str) -> str:
+    """rx as an alternation branch; leading (?flags) become a scoped (?flags:...) group."""
+    flags = ""
+    m = _INLINE_FLAGS_RE.match(rx)
+    while m:
+        flags += m.group(1)
+        rx = rx[m.end():]
+        m = _INLINE_FLAGS_RE.match(rx)
+    return f"(?{''.join(sorted(set(flags)))}:{rx})" if flags else f"(?:{rx})"
+
+def load_blocked_regex(conn):
+    """Enabled regex blacklist entries compiled into one alternation (None if none usable)."""
+    try:
+        rows = conn.execute("SELECT domain FROM domainlist WHERE type = 3 AND enabled = 1").fetchall()
+    except Exception:
+        return None
+    parts = []
+    for (rx,) in rows:
+        part = _scoped_regex(rx)
+        try:
+            re.compile(part)  # validate as it will appear inside the alternation
+        except re.error:
+            continue  # Pi-hole extensions / POSIX-only syntax
+        parts.append(part)
+    if not parts:
+        return None
+    try:
+        return re.compile("|".join(parts))
+    except re.error:
+        return None
+
+def is_blocked(domain: str, blocked: set, blocked_re) -> bool:
+    return domain in blocked or (blocked_re is not None and blocked_re.search(domain) is not None)
+
+# ---- Quarantine store ----
+QUARANTINE_COLS = ("first_seen", "last_seen", "score", "reason", "hits", "uniq", "hours")
+
+def _quarantine_row(d: str, v: dict) -> tuple:
+    return (
+        d, int(v.get("first_seen", 0)), int(v.get("last_seen", 0)), float(v.get("score", 0.0)),
+        v.get("reason", ""), int(v.get("hits", 0)), int(v.get("uniq", 0)), int(v.get("hours", 0)),
+    )
+
+def open_quarantine_db(db_path: str, legacy_json: str = None):
+    """Open (creating if needed) the quarantine table; a new DB imports the legacy JSON once."""
+    fresh = not Path(db_path).exists()
+    Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+    conn = open_db(db_path, readonly=False)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS q (
+            domain TEXT PRIMARY KEY, first_seen INT, last_seen INT, score REAL,
+            reason TEXT, hits INT, uniq INT, hours INT
+        )
+        """
+    )
+    if fresh and legacy_json:
+        legacy = load_json(legacy_json, {})
+        if isinstance(legacy, dict) and legacy:
+            save_quarantine(conn, legacy, legacy.keys(), ())
+    return conn
+
+def load_quarantine(conn) -> dict:
+    rows = conn.execute(f"SELECT domain, {', '.join(QUARANTINE_COLS)} FROM q").fetchall()
+    return {d: dict(zip(QUARANTINE_COLS, rest)) for d, *rest in rows}
+
+def save_quarantine(conn, quarantine: dict, changed, dropped):
+    """Upsert changed entries and delete dropped ones in a single transaction."""
+    with conn:
+        conn.executemany("DELETE FROM q WHERE domain = ?", [(d,) for d in dropped])
+        conn.executemany(
+            f"""
+            INSERT INTO q (domain, {', '.join(QUARANTINE_COLS)}) VALUES (?,?,?,?,?,?,?,?)
+            ON CONFLICT(domain) DO UPDATE SET
+            {', '.join(f'{c}=excluded.{c}' for c in QUARANTINE_COLS)}
+            """,
+            [_quarantine_row(d, quarantine[d]) for d in changed if d in quarantine],
+        )
 
 # ---- Heuristics ----
+def build_matcher(groups: dict):
+    """Return find(text) -> {kind: first matching word} for each kind of word list, scanning text once."""
+    words = {}
+    for kind, ws in groups.items():
+        for w in ws:
+            if w:
+                words.setdefault(w.lower(), []).append(kind)
+    if not words:
+        return lambda text: {}
+    if ahocorasick is not None:
+        A = ahocorasick.Automaton()
+        for w, kinds in words.items():
+            A.add_word(w, (tuple(kinds), w))
+        A.make_automaton()
+        need = len({k for kinds in words.values() for k in kinds})
+        def find(text):
+            hits = {}
+            for _, (kinds, w) in A.iter(text):
+                for k in kinds:
+                    hits.setdefault(k, w)
+                if len(hits) == need:
+                    break
+            return hits
+        return find
+    pats = [
+        (kind, re.compile("|".join(re.escape(w) for w in sorted(ws, key=len, reverse=True))))
+        for kind, ws in ((k, {w for w, kinds in words.items() if k in kinds}) for k in groups)
+        if ws
+    ]
+    def find(text):
+        hits = {}
+        for kind, pat in pats:
+            m = pat.search(text)
+            if m:
+                hits[kind] = m.group(0)
+        return hits
+    return find
+
+def compile_heuristics(cfg):
+    """Build the combined substring matcher once per run (after LEARNED is loaded)."""
+    global HEUR_MATCH
+    HEUR_MATCH = build_matcher({"substr": cfg.suspicious_substrings, "learn": LEARNED})
+
 def substr_or_tld_suspicious(domain: str, cfg) -> tuple[bool, list]:
     """Return (is_suspicious, reasons[]) for cheap checks."""
     reasons = []
-    d = domain.lower()
-    if domain_suffix_in_list(d, cfg.get("allowlist", [])):
+    d = domain.lower().rstrip('.')
+    if domain_suffix_in_set(d, cfg.allow_suffixes):
         return False, ["allowlist"]
-    # static substrings
-    for ss in (cfg.get("suspicious_substrings") or []):
-        if ss and ss.lower() in d:
-            reasons.append(f"substr:{ss}")
-            break
-    # learned substrings
-    if LEARNED:
-        for tok in LEARNED:
-            if tok in d:
-                reasons.append(f"learn:{tok}")
-                break
+    # static + learned substrings in one pass
+    hits = HEUR_MATCH(d)
+    if "substr" in hits:
+        reasons.append(f"substr:{hits['substr']}")
+    if "learn" in hits:
+        reasons.append(f"learn:{hits['learn']}")
     # suspicious TLDs
-    if domain_suffix_in_list(d, cfg.get("suspicious_tlds", [])):
+    if domain_suffix_in_set(d, cfg.tld_suffixes):
         reasons.append("tld")
     # family reputation by eTLD+1
-    parts = d.strip('.').split('.')
-    etld1 = ".".join(parts[-2:]) if len(parts) >= 2 else d
+    etld1 = etld1_fast(d.strip('.'))
     if FAMS and etld1 in FAMS:
         reasons.append(f"fam:{etld1}")
     return (len(reasons) > 0), reasons
 
+def make_resolver(cache_only: bool):
+    """One resolver (and its answer cache) shared by every lookup and worker thread."""
+    r = dns.resolver.Resolver(configure=False)
+    r.nameservers = ["127.0.0.1"]
+    r.lifetime = 2
+    r.cache = dns.resolver.LRUCache(10000)  # chains converging on shared CDN hops resolve them once
+    if cache_only:
+        r.flags = 0  # no RD bit: answer from FTL's cache only
+    return r
+
+def cname_target(name: str):
+    """Return the CNAME target of name, or None."""
+    if RESOLVER is not None:
+        ans = RESOLVER.resolve(name, "CNAME", raise_on_no_answer=False)
+        return str(ans.rrset[0].target).rstrip('.') if ans.rrset else None
+    if CFG.cname_cache_only:
+        dig_cmd = ["dig", "@127.0.0.1", "+norecurse", "+time=2", "+tries=0", "+short", name, "CNAME"]
+    else:
+        dig_cmd = ["dig", "@127.0.0.1", "+short", name, "CNAME"]
+    out = subprocess.run(dig_cmd, capture_output=True, text=True, timeout=4)
+    lines = [l.strip().rstrip('.') for l in out.stdout.splitlines() if l.strip()]
+    return lines[0] if lines else None
+
+def _cached_chain(d: str, now: int):
+    """Chain from the persistent (TTL) or in-run cache, else None."""
+    pc = CNAME_PERSIST.get(d)
+    if pc and pc.get('until', 0) > now:
+        return pc.get('chain', [])
+    return CNAME_CACHE.get(d)
+
+def _store_chain(d: str, chain: list, now: int):
+    CNAME_CACHE[d] = chain
+    # persist with TTL
+    CNAME_PERSIST[d] = {"chain": chain, "until": now + CFG.cname_cache_ttl_hours * 3600}
+
 def resolve_cname_chain(domain: str, max_depth: int = 0) -> list[str]:
-    """Resolve up to max_depth CNAMEs using dig; supports cache-only + persistent cache."""
+    """Resolve up to max_depth CNAMEs; supports cache-only + persistent cache."""
     if max_depth < 1:
         return []
     d = domain.lower().rstrip('.')
-    # persistent cache check
-    pc = CNAME_PERSIST.get(d)
     now = now_ts()
-    if pc and pc.get('until', 0) > now:
-        return pc.get('chain', [])
-    if d in CNAME_CACHE:
-        return CNAME_CACHE[d]
+    cached = _cached_chain(d, now)
+    if cached is not None:
+        return cached
     chain = []
     current = d
     for _ in range(max_depth):
         try:
-            if CFG.get('cname_cache_only', False):
-                dig_cmd = ["dig", "@127.0.0.1", "+norecurse", "+time=2", "+tries=0", "+short", current, "CNAME"]
-            else:
-                dig_cmd = ["dig", "@127.0.0.1", "+short", current, "CNAME"]
-            out = subprocess.run(dig_cmd, capture_output=True, text=True, timeout=4)
-            lines = [l.strip().rstrip('.') for l in out.stdout.splitlines() if l.strip()]
-            if not lines:
+            target = cname_target(current)
+            if not target:
                 break
-            target = lines[0]
             chain.append(target)
             current = target
         except Exception:
             break
-    CNAME_CACHE[d] = chain
-    # persist with TTL
-    ttl = int(CFG.get('cname_cache_ttl_hours', 24)) * 3600
-    CNAME_PERSIST[d] = {"chain": chain, "until": now + ttl}
+    _store_chain(d, chain, now)
     return chain
 
+async def _cname_query(resolver, name: str):
+    if hasattr(resolver, "query_dns"):  # aiodns >= 4 (query() is deprecated there)
+        res = await resolver.query_dns(name, "CNAME")
+        for rr in res.answer:
+            if rr.type == pycares.QUERY_TYPE_CNAME:
+                return rr.data.cname
+        return None
+    res = await resolver.query(name, "CNAME")
+    return res.cname if res else None
+
+async def _resolve_one(resolver, sem, d: str, max_depth: int, now: int):
+    chain = []
+    current = d
+    async with sem:
+        for _ in range(max_depth):
+            try:
+                target = await _cname_query(resolver, current)
+            except aiodns.error.DNSError:  # NXDOMAIN/NODATA/timeout/refused
+                break
+            if not target:
+                break
+            target = target.rstrip('.')
+            chain.append(target)
+            current = target
+    _store_chain(d, chain, now)
+
+async def _resolve_all(domains: list[str], max_depth: int, now: int):
+    sem = asyncio.Semaphore(max(1, CFG.cname_concurrency))
+    kw = {"flags": pycares.ARES_FLAG_NORECURSE} if CFG.cname_cache_only else {}
+    resolver = aiodns.DNSResolver(nameservers=["127.0.0.1"], timeout=2, tries=1, **kw)
+    try:
+        await asyncio.gather(*(_resolve_one(resolver, sem, d, max_depth, now) for d in domains))
+    finally:
+        close = getattr(resolver, "close", None)  # aiodns >= 3.3
+        if close is not None:
+            await close()
+
+def prefetch_cname_chains(domains: list[str], max_depth: int):
+    """Resolve chains concurrently (IO-bound); results land in the CNAME caches."""
+    if max_depth < 1 or not domains:
+        return
+    now = now_ts()
+    pending = list({d.lower().rstrip('.') for d in domains})
+    pending = [d for d in pending if _cached_chain(d, now) is None]
+    if not pending:
+        return
+    if aiodns is not None:
+        try:
+            asyncio.run(_resolve_all(pending, max_depth, now))
+            return
+        except Exception:
+            pass  # fall back to the thread pool for anything not yet cached
+        pending = [d for d in pending if d not in CNAME_CACHE]
+    workers = max(1, CFG.cname_workers)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        list(ex.map(lambda d: resolve_cname_chain(d, max_depth), pending))
+
 def cname_suspicious(domain: str, cfg) -> tuple[bool, list]:
-    max_depth = int(cfg.get("cname_max_depth", 0))
+    max_depth = cfg.cname_max_depth
     if max_depth < 1:
         return False, []
     reasons = []
     chain = resolve_cname_chain(domain, max_depth)
     for cname in chain:
-        if domain_suffix_in_list(cname, cfg.get("allowlist", [])):
+        c = cname.lower()
+        if domain_suffix_in_set(c, cfg.allow_suffixes):
             return False, ["cname_allowlist"]
-        if any(ss in cname for ss in (cfg.get("suspicious_substrings") or [])):
+        hits = HEUR_MATCH(c)
+        if "substr" in hits:
             reasons.append(f"cname_substr:{cname}")
             break
-        if LEARNED and any(tok in cname for tok in LEARNED):
+        if "learn" in hits:
             reasons.append(f"cname_learn:{cname}")
             break
-        if domain_suffix_in_list(cname, cfg.get("suspicious_tlds", [])):
+        if domain_suffix_in_set(c, cfg.tld_suffixes):
             reasons.append(f"cname_tld:{cname}")
             break
-        parts = cname.lower().strip('.').split('.')
-        etld1 = ".".join(parts[-2:]) if len(parts) >= 2 else cname
+        etld1 = etld1_fast(c.strip('.'))
         if FAMS and etld1 in FAMS:
             reasons.append(f"cname_fam:{etld1}")
             break
@@ -222,181 +630,204 @@ def cname_suspicious(domain: str, cfg) -> tuple[bool, list]:
 # ---- Learned keywords & family reputation ----
 
 def load_persist_cache(cfg):
-    path = cfg.get("cname_cache_path")
+    """Live entries only: expired chains are dropped here instead of round-tripping through save."""
+    path = cfg.cname_cache_path
     if not path:
         return {}
     data = load_json(path, {})
-    return data if isinstance(data, dict) else {}
+    if not isinstance(data, dict):
+        return {}
+    now = now_ts()
+    return {d: e for d, e in data.items() if e.get("until", 0) > now}
 
 def save_persist_cache(cfg):
-    path = cfg.get("cname_cache_path")
+    path = cfg.cname_cache_path
     if not path:
         return
+    if not CNAME_CACHE and Path(path).exists():
+        return  # no lookups this run; expired entries are pruned again on the next load
     save_json(path, CNAME_PERSIST)
 
+_LOWER_TBL = bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", b"abcdefghijklmnopqrstuvwxyz")
+
 def load_learned_keywords(cfg):
-    path = cfg.get("learned_keywords_path")
-    if not (cfg.get("auto_learn_keywords") and path):
+    path = cfg.learned_keywords_path
+    if not (cfg.auto_learn_keywords and path):
         return set()
     data = load_json(path, {"keywords": [], "built_at": 0})
     return set(data.get("keywords", []))
 
-def maybe_rebuild_learned_keywords(cfg):
-    if not cfg.get("auto_learn_keywords"):
-        return
-    path = cfg.get("learned_keywords_path")
-    ttl = int(cfg.get("learn_refresh_hours", 24)) * 3600
-    state = load_json(path, {"keywords": [], "built_at": 0})
-    if now_ts() - state.get("built_at", 0) < ttl:
-        return
-    try:
-        conn = sqlite3.connect("/etc/pihole/gravity.db"); cur = conn.cursor()
-        cur.execute("SELECT domain FROM gravity")
-        rows = [r[0] for r in cur.fetchall()]
-        conn.close()
-    except Exception:
-        return
-    from collections import defaultdict
-    def etld1(d):
-        p = d.lower().strip('.').split('.')
-        return ".".join(p[-2:]) if len(p) >= 2 else d
-    stop = set((cfg.get("learn_stopwords") or []))
+def rebuild_learned_and_fams(cfg, conn) -> Optional[tuple[set, set]]:
+    """One pass over gravity for family reputation and the (TTL-gated) learned keywords.
+
+    Returns None if gravity could not be scanned, so callers don't mistake it for "no families".
+    """
+    learned = load_learned_keywords(cfg)
+    th = cfg.family_adlist_threshold
+    path = cfg.learned_keywords_path
+    learn = False
+    if cfg.auto_learn_keywords and path:
+        state = load_json(path, {"keywords": [], "built_at": 0})
+        learn = now_ts() - state.get("built_at", 0) >= cfg.learn_refresh_hours * 3600
+    if th <= 0 and not learn:
+        return learned, set()
+    # Rows stay bytes (ASCII-lowercased in C via translate); only the survivors are decoded
+    stop = {w.lower().encode() for w in cfg.learn_stopwords}
+    root_to_adlists = defaultdict(set)
     token_to_etlds = defaultdict(set)
-    for dom in rows:
-        parts = [x for x in dom.split('.') if x and x not in stop and len(x) >= 3]
-        root = etld1(dom)
-        for t in parts:
-            token_to_etlds[t].add(root)
-    min_sup = int(cfg.get("learn_min_support_etlds", 8))
-    cand = [t for t, s in token_to_etlds.items() if len(s) >= min_sup]
-    cand = sorted(cand, key=lambda t: len(token_to_etlds[t]), reverse=True)
-    cand = cand[: int(cfg.get("learn_max_keywords", 200))]
-    save_json(path, {"keywords": cand, "built_at": now_ts()})
-
-
-def build_reputation_families(cfg):
-    th = int(cfg.get("family_adlist_threshold", 0))
-    if th <= 0:
-        return set()
-    fams = set()
     try:
-        conn = sqlite3.connect("/etc/pihole/gravity.db"); cur = conn.cursor()
-        cur.execute("SELECT domain, adlist_id FROM gravity")
-        from collections import defaultdict
-        counts = defaultdict(set)
-        for dom, aid in cur.fetchall():
-            parts = dom.lower().strip('.').split('.')
-            root = ".".join(parts[-2:]) if len(parts) >= 2 else dom
-            counts[root].add(aid)
-        conn.close()
-        for root, s in counts.items():
-            if len(s) >= th:
-                fams.add(root)
+        for dom, aid in conn.execute("SELECT CAST(domain AS BLOB), adlist_id FROM gravity"):
+            d = dom.translate(_LOWER_TBL).strip(b'.')
+            a, _, c = d.rpartition(b'.')  # etld1_fast, on bytes
+            root = a.rpartition(b'.')[2] + b'.' + c if a else c
+            if th > 0:
+                root_to_adlists[root].add(aid)
+            if learn:
+                for t in d.split(b'.'):
+                    if t and t not in stop and len(t) >= 3:
+                        token_to_etlds[t].add(root)
     except Exception:
-        return set()
-    return fams
-
-# ---- Extra filters ----
-
-def hours_active_map(ftl_db, lookback_hours):
+        return None
+    fams = {root.decode(errors='ignore') for root, s in root_to_adlists.items() if len(s) >= th}
+    if learn:
+        min_sup = cfg.learn_min_support_etlds
+        cand = [t for t, s in token_to_etlds.items() if len(s) >= min_sup]
+        cand = sorted(cand, key=lambda t: len(token_to_etlds[t]), reverse=True)
+        cand = [t.decode(errors='ignore') for t in cand[: cfg.learn_max_keywords]]
+        save_json(path, {"keywords": cand, "built_at": now_ts()})
+        learned = set(cand)
+    return learned, fams
+
+def gravity_stamp(conn):
+    """When the gravity table was last rebuilt (`pihole -g`); falls back to the file stamp.
+
+    Unlike the file mtime, this doesn't move when domainlist changes (e.g. our own promotions).
+    """
     try:
-        conn = sqlite3.connect(ftl_db); cur = conn.cursor()
-        since = int(time.time()) - lookback_hours * 3600
-        cur.execute(
-            """
-            SELECT domain, COUNT(DISTINCT strftime('%Y%m%d%H', datetime(timestamp,'unixepoch'))) AS hrs
-            FROM queries
-            WHERE timestamp >= ?
-            GROUP BY domain
-            """,
-            (since,),
-        )
-        out = dict(cur.fetchall()); conn.close(); return out
+        row = conn.execute("SELECT value FROM info WHERE property = 'updated'").fetchone()
+        if row and row[0] is not None:
+            return int(row[0])
     except Exception:
-        return {}
-
-# ---- Scoring ----
-
-def compute_score(domain: str, metrics: dict, reasons: list[str], cfg) -> float:
-    """Combine traffic + heuristic signals into 0..1."""
-    hits = float(metrics.get("hits", 0))
-    uniq = float(metrics.get("uniq", 0))
-    hrs  = float(metrics.get("hours", 0))
+        pass
+    return db_mtime_ns(GRAVITY_DB)
 
-    # Normalize with soft saturations
-    def norm(x, k):
-        # logistic-ish squash around k
+def load_or_build_fams_learned(cfg, conn) -> tuple[frozenset, frozenset]:
+    """(learned, fams), reusing the marshal'd result of the last scan until gravity is rebuilt."""
+    path = cfg.fams_cache_path
+    key = None
+    if path:
         try:
-            x = float(x)
+            key = (gravity_stamp(conn), cfg.family_adlist_threshold, cfg.auto_learn_keywords,
+                   cfg.learn_min_support_etlds, cfg.learn_max_keywords, cfg.learn_stopwords)
+            with open(path, "rb") as f:
+                cached_key, learned, fams = marshal.load(f)
+            if cached_key == key:
+                return learned, fams
         except Exception:
-            x = 0.0
-        return x / (x + k)
-
-    hN = norm(hits, float(cfg.get("score_hits_k", 20)))
-    uN = norm(uniq, float(cfg.get("score_uniq_k", 3)))
-    tN = norm(hrs,  float(cfg.get("score_hours_k", 6)))
-
-    # Heuristic boosters
-    boost = 0.0
-    for r in reasons:
-        if r.startswith("substr:"):
-            boost += 0.25
-        elif r.startswith("learn:"):
-            boost += 0.15
-        elif r == "tld" or r.startswith("cname_tld"):
-            boost += 0.20
-        elif r.startswith("fam:") or r.startswith("cname_fam"):
-            boost += 0.15
-        elif r.startswith("cname_"):
-            boost += 0.20
-    boost = min(boost, 0.6)
-
-    # Weighted blend
-    base = 0.4*hN + 0.3*uN + 0.3*tN
-    score = max(0.0, min(1.0, base + boost))
-    return float(score)
+            pass
+    built = rebuild_learned_and_fams(cfg, conn)
+    if built is None:
+        return frozenset(load_learned_keywords(cfg)), frozenset()  # scan failed: use it, don't cache it
+    learned, fams = frozenset(built[0]), frozenset(built[1])
+    if key is not None:
+        try:
+            with open(path, "wb") as f:
+                marshal.dump((key, learned, fams), f)
+        except OSError:
+            pass
+    return learned, fams
+
+# ---- Scoring ----
+
+# Heuristic boosters by reason kind (the part before ':'); other cname_* reasons get 0.20
+REASON_BOOST = {
+    "substr": 0.25, "learn": 0.15, "tld": 0.20, "fam": 0.15,
+    "cname_tld": 0.20, "cname_fam": 0.15,
+}
+
+def compute_scores(candidates: list, reasons_by_domain: dict, cfg) -> list[float]:
+    """Combine traffic + heuristic signals into 0..1 for a whole batch of (domain, metrics)."""
+    kh, ku, kt = cfg.score_hits_k, cfg.score_uniq_k, cfg.score_hours_k
+    boost_of = REASON_BOOST.get
+    scores = []
+    for d, m in candidates:
+        # Normalize with soft saturations (logistic-ish squash around k)
+        hits, uniq, hrs = m.get("hits", 0), m.get("uniq", 0), m.get("hours", 0)
+        base = 0.4*(hits/(hits + kh)) + 0.3*(uniq/(uniq + ku)) + 0.3*(hrs/(hrs + kt))
+        boost = 0.0
+        for r in reasons_by_domain.get(d, ()):
+            kind = r.partition(":")[0]
+            boost += boost_of(kind, 0.20 if kind.startswith("cname_") else 0.0)
+        scores.append(max(0.0, min(1.0, base + min(boost, 0.6))))
+    return scores
 
 # ---- Promotions ----
 
-def sql_promote(domain: str, comment: str, group_name: str = "Default") -> bool:
+def bulk_blacklist(conn, domains: list[str], comment: str, group_name: str = "Default") -> Optional[int]:
+    """Blacklist all domains in one transaction; returns rows changed (None on failure).
+
+    Disabled exact entries are re-enabled rather than skipped. BEGIN IMMEDIATE takes the write
+    lock up front, so a concurrent pihole/FTL writer makes us wait instead of failing mid-batch.
+    """
+    if not domains:
+        return 0
     try:
-        conn = sqlite3.connect("/etc/pihole/gravity.db"); cur = conn.cursor()
-        row = cur.execute("SELECT id FROM 'group' WHERE name=? AND enabled=1;", (group_name,)).fetchone()
+        row = conn.execute("SELECT id FROM 'group' WHERE name=? AND enabled=1;", (group_name,)).fetchone()
         if not row:
-            conn.close(); return False
+            return None
         gid = row[0]
-        cur.execute(
-            """
-            INSERT INTO domainlist (type,domain,enabled,comment,date_added,date_modified)
-            VALUES (1,?,1,?,strftime('%s','now'),strftime('%s','now'))
-            """,
-            (domain, comment),
-        )
-        dlid = cur.execute("SELECT id FROM domainlist WHERE domain=? ORDER BY id DESC LIMIT 1;", (domain,)).fetchone()[0]
-        cur.execute(
-            "INSERT OR IGNORE INTO domainlist_by_group (domainlist_id,group_id) VALUES (?,?)",
-            (dlid, gid),
-        )
-        conn.commit(); conn.close()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # rowcount, not total_changes: the latter also counts rows written by gravity.db triggers
+            changed = conn.executemany(
+                """
+                INSERT INTO domainlist (type,domain,enabled,comment,date_added,date_modified)
+                VALUES (1,?,1,?,strftime('%s','now'),strftime('%s','now'))
+                ON CONFLICT(domain,type) DO UPDATE SET enabled=1, date_modified=strftime('%s','now')
+                WHERE enabled=0
+                """,
+                [(d, comment) for d in domains],
+            ).rowcount
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO domainlist_by_group (domainlist_id,group_id)
+                SELECT id, ? FROM domainlist WHERE domain=? AND type=1
+                """,
+                [(gid, d) for d in domains],
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return changed
+    except Exception:
+        return None
+
+def reload_lists():
+    try:
         subprocess.run(["pihole", "restartdns", "reload-lists"], capture_output=True, text=True, timeout=20)
-        return True
     except Exception:
-        return False
+        pass
 
-def add_to_blacklist(domain: str, cfg) -> bool:
-    if cfg.get("sql_promotion", False):
-        ok = sql_promote(domain, cfg.get("promotion_comment", "autoblocker"), cfg.get("promotion_group", "Default"))
-        if ok:
-            return True
+def add_to_blacklist(conn, domains: list[str], cfg) -> list[str]:
+    """Promote a batch of domains; returns the ones that were blocked."""
+    if not domains:
+        return []
+    if cfg.sql_promotion:
+        changed = bulk_blacklist(conn, domains, cfg.promotion_comment, cfg.promotion_group)
+        if changed is not None:
+            if changed:
+                reload_lists()  # once per batch, and only if the blacklist actually changed
+            return list(domains)
     try:
-        r = subprocess.run(["pihole", "-b", domain], capture_output=True, text=True, timeout=20)
-        return r.returncode == 0
+        r = subprocess.run(["pihole", "-b", *domains], capture_output=True, text=True, timeout=120)
+        return list(domains) if r.returncode == 0 else []
     except Exception:
-        return False
+        return []
 
 # ---- Metrics ----
 def write_metrics(cfg, cand_count, promo_count):
-    path = cfg.get("metrics_path")
+    path = cfg.metrics_path
     if not path:
         return
     content = (
@@ -409,16 +840,13 @@ def write_metrics(cfg, cand_count, promo_count):
 
 # ---- Output (adlist file) ----
 
-def gather_promoted_from_db(comment: str) -> set:
-    out = set()
+def gather_promoted_from_db(conn, comment: str) -> Optional[set]:
+    """Domains promoted via the SQL path, or None if gravity.db could not be queried."""
     try:
-        conn = sqlite3.connect("/etc/pihole/gravity.db"); cur = conn.cursor()
-        cur.execute("SELECT domain FROM domainlist WHERE enabled=1 AND type IN (1,3) AND comment=?", (comment,))
-        out.update(r[0] for r in cur.fetchall())
-        conn.close()
+        rows = conn.execute("SELECT domain FROM domainlist WHERE enabled=1 AND type IN (1,3) AND comment=?", (comment,))
+        return {r[0] for r in rows.fetchall()}
     except Exception:
-        pass
-    return out
+        return None
 
 def read_lines(path: str) -> set:
     p = Path(path)
@@ -429,29 +857,53 @@ def read_lines(path: str) -> set:
     except Exception:
         return set()
 
-def write_output_list(cfg):
-    """Compose final blocklist file for Pi-hole adlist ingestion."""
-    output_path = cfg.get("output_file", "/etc/pihole/pihole-autoblocker.txt")
-    allow_file = cfg.get("allowlist_file", "/etc/pihole/pihole-autoblocker.allow.txt")
-    manual_file = cfg.get("manual_block_file", "/etc/pihole/pihole-autoblocker.manual-block.txt")
-    promo_comment = cfg.get("promotion_comment", "autoblocker")
+def write_output_list(cfg, gravity, state: dict):
+    """Compose final blocklist file for Pi-hole adlist ingestion.
+
+    state caches the promoted set (per gravity.db stamp) and the hash of the last file written,
+    so a steady-state run neither queries gravity nor rewrites identical bytes.
+    """
+    output_path = cfg.output_file
+    allow_file = cfg.allowlist_file
+    manual_file = cfg.manual_block_file
+    promo_comment = cfg.promotion_comment
+
+    # Items promoted via SQL path: only requery when gravity.db changed
+    gmt = db_mtime_ns(GRAVITY_DB)
+    if state.get("promoted_mtime") == gmt and state.get("promoted_comment") == promo_comment:
+        promoted = set(state.get("promoted", []))
+    else:
+        promoted = gather_promoted_from_db(gravity, promo_comment)
+        if promoted is None:
+            # query failed: keep the last known set and leave the stamp alone so the next run retries
+            promoted = set(state.get("promoted", []))
+        else:
+            state["promoted"] = sorted(promoted)
+            state["promoted_mtime"] = gmt
+            state["promoted_comment"] = promo_comment
 
     # Sources
     S = set()
     S |= read_lines(manual_file)                     # operator-curated
-    S |= gather_promoted_from_db(promo_comment)      # items promoted via SQL path
+    S |= promoted
 
     # Filter allowlist + sanity
     ALLOW = read_lines(allow_file)
     S = {d for d in S if d and d not in ALLOW}
 
-    # Write sorted unique
-    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-    Path(output_path).write_text("".join(sorted(S)) + ("" if S else ""))
+    # Write sorted unique (skipped when the bytes would be identical)
+    data = "".join(d + "\n" for d in sorted(S)).encode()
+    h = hashlib.blake2b(data, digest_size=16).hexdigest()
+    written = False
+    if state.get("output_hash") != h or not Path(output_path).exists():
+        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(output_path).write_bytes(data)
+        state["output_hash"] = h
+        written = True
 
     # Optional legacy mirror (symlink)
-    legacy = cfg.get("legacy_output_symlink")
-    if legacy:
+    legacy = cfg.legacy_output_symlink
+    if legacy and (written or not Path(legacy).exists()):
         try:
             lp = Path(legacy)
             if lp.exists() or lp.is_symlink():
@@ -466,11 +918,49 @@ def write_output_list(cfg):
             except Exception:
                 pass
 
+REVIEW_FIELDS = ("domain", "score", "reason", "first_seen", "last_seen", "hits", "uniq", "hours")
+
+def write_review_exports(quarantine: dict, review_json: str, review_tsv: str, now: int):
+    """Operator-facing copies of the quarantine, sorted by score.
+
+    Both files are streamed row by row from one sorted pass (one JSON object per line),
+    instead of materializing the whole export as lists/strings first.
+    """
+    rows = sorted(quarantine.items(), key=lambda kv: kv[1].get("score", 0.0), reverse=True)
+    Path(review_json).parent.mkdir(parents=True, exist_ok=True)
+    Path(review_tsv).parent.mkdir(parents=True, exist_ok=True)
+    if orjson is not None:
+        dumps = lambda o: orjson.dumps(o, option=orjson.OPT_SORT_KEYS)
+    else:
+        dumps = lambda o: json.dumps(o, sort_keys=True).encode()
+    with open(review_json, "wb", buffering=1 << 16) as jf, open(review_tsv, "w", buffering=1 << 16) as tf:
+        tf.write("\t".join(REVIEW_FIELDS) + "\n")
+        jf.write(b"[")
+        sep = b"\n  "
+        for d, v in rows:
+            rec = {
+                "domain": d,
+                "score": float(v.get("score",0.0)),
+                "reason": v.get("reason", ""),
+                "first_seen": int(v.get("first_seen", now)),
+                "last_seen": int(v.get("last_seen", now)),
+                "hits": int(v.get("hits", 0)),
+                "uniq": int(v.get("uniq", 0)),
+                "hours": int(v.get("hours", 0))
+            }
+            jf.write(sep)
+            jf.write(dumps(rec))
+            sep = b",\n  "
+            tf.write(
+                f"{d}\t{rec['score']:.3f}\t{rec['reason']}\t{rec['first_seen']}\t{rec['last_seen']}\t{rec['hits']}\t{rec['uniq']}\t{rec['hours']}\n"
+            )
+        jf.write(b"\n]\n" if rows else b"]\n")
+
 # ---- Main ----
 
 def main():
-    global CFG, LEARNED, FAMS, CNAME_PERSIST
-    CFG = load_yaml("/etc/pihole-autoblocker/config.yml")
+    global CFG, LEARNED, FAMS, CNAME_PERSIST, RESOLVER
+    CFG = Cfg.from_dict(load_yaml("/etc/pihole-autoblocker/config.yml"))
 
     # Concurrency lock
     try:
@@ -481,73 +971,86 @@ def main():
         print("Another instance is running; exiting."); return
 
     # Paths
-    quar_path = CFG.get("quarantine_file")  # dict keyed by domain
-    state_path = CFG.get("state_file")
-    review_json = CFG.get("quarantine_review_file") or str(Path(quar_path).with_name("quarantine_review.json"))
-    review_tsv  = CFG.get("quarantine_tsv_file") or str(Path(quar_path).with_suffix(".tsv"))
-
-    quarantine = load_json(quar_path, {})
+    quar_path = CFG.quarantine_file  # legacy JSON dict keyed by domain (imported once)
+    quar_db = CFG.quarantine_db or str(Path(quar_path).with_suffix(".db"))
+    state_path = CFG.state_file
+    review_json = CFG.quarantine_review_file or str(Path(quar_path).with_name("quarantine_review.json"))
+    review_tsv  = CFG.quarantine_tsv_file or str(Path(quar_path).with_suffix(".tsv"))
+
+    qconn = open_quarantine_db(quar_db, quar_path)
+    quarantine = load_quarantine(qconn)
     state = load_json(state_path, {"blocked": []})
 
-    # Caches & learned data
+    # One connection per database for the whole run
+    ftl = open_db(CFG.ftl_db, pragmas=FTL_PRAGMAS) if CFG.ftl_db else None
+    gravity = open_db(GRAVITY_DB, readonly=False)  # promotions write through it
+
+    # Caches & resolver
     CNAME_PERSIST = load_persist_cache(CFG)
-    LEARNED = load_learned_keywords(CFG)
-    FAMS = build_reputation_families(CFG)
-    maybe_rebuild_learned_keywords(CFG)
-
-    # Domain counts
-    lookback = int(CFG.get("lookback_hours", 24))
-    counts = get_recent_counts_from_ftl(CFG.get("ftl_db"), lookback)
-    if not counts:
-        counts = fallback_counts_from_log(lookback)
-
-    # Add hours-active metric
-    hrs_map = hours_active_map(CFG.get("ftl_db"), lookback) if counts else {}
-
-    min_hits = int(CFG.get("min_hits", 10))
-    min_unique = int(CFG.get("min_unique_clients", 2))
-    q_hours = int(CFG.get("quarantine_hours", 12))
-    top_n_cname = int(CFG.get("top_n_cname", 200))
-
-    # 1) Thresholds first
-    eligible = []
-    for d, m in counts.items():
-        if m.get("hits",0) >= min_hits and m.get("uniq",0) >= min_unique:
-            m["hours"] = hrs_map.get(d, 0)
-            eligible.append((d, m))
-
-    # 1b) Temporal diversity
-    min_hours = int(CFG.get("min_hours_active", 0))
-    if min_hours > 0 and eligible:
-        eligible = [(d, m) for d, m in eligible if m.get("hours",0) >= min_hours]
-
-    # 2) Already blocked anywhere?
-    eligible = [(d, m) for d, m in eligible if not is_already_blocked_anywhere(d)]
+    if dns is not None:
+        RESOLVER = make_resolver(CFG.cname_cache_only)
+
+    min_hits = CFG.min_hits
+    min_unique = CFG.min_unique_clients
+    q_hours = CFG.quarantine_hours
+    top_n_cname = CFG.top_n_cname
+
+    # Domain counts + active hours (all thresholds applied at the source, one FTL pass)
+    lookback = CFG.lookback_hours
+    min_hours = CFG.min_hours_active
+    blocked_in_sql = ftl is not None and attach_gravity(ftl)
+    rows = get_ftl_stats(ftl, lookback, min_hits, min_unique, min_hours, exclude_blocked=blocked_in_sql)
+    if rows is None and blocked_in_sql:
+        # the gravity half may be what failed (e.g. locked during `pihole -g`): retry FTL alone
+        blocked_in_sql = False
+        rows = get_ftl_stats(ftl, lookback, min_hits, min_unique, min_hours)
+    if rows is None:  # FTL unavailable, not merely quiet
+        rows = fallback_counts_from_log(lookback, min_hits, min_unique)
+
+    # 1) Thresholds first (1b: temporal diversity; only the log fallback still needs it here)
+    eligible = [(d, {"hits": h, "uniq": u, "hours": hrs}) for d, h, u, hrs in rows if hrs >= min_hours]
+
+    # 2) Already blocked anywhere? Exact hits were dropped in SQL unless we fell back to the log;
+    #    regex entries are always matched here (reused for promotion re-check)
+    blocked = set() if blocked_in_sql else already_blocked_set(gravity, {d for d, _ in eligible})
+    blocked_re = load_blocked_regex(gravity)
+    eligible = [(d, m) for d, m in eligible if not is_blocked(d, blocked, blocked_re)]
+
+    # Learned keywords / family reputation: only worth a gravity scan if something will be scored
+    if eligible:
+        LEARNED, FAMS = load_or_build_fams_learned(CFG, gravity)
+    compile_heuristics(CFG)
 
     # 3) Cheap heuristic
     cheap_flags = {}
     candidates = []
+    cand_set = set()
     for d, m in eligible:
         sus, reasons = substr_or_tld_suspicious(d, CFG)
         if sus:
             cheap_flags[d] = reasons
             candidates.append((d, m))
+            cand_set.add(d)
 
     # 4) CNAME only for top-N busiest remaining
-    rem = [(d, m) for (d, m) in eligible if d not in cheap_flags]
-    rem = sorted(rem, key=lambda x: x[1].get("hits",0), reverse=True)[:top_n_cname]
+    rem = heapq.nlargest(
+        top_n_cname, ((d, m) for (d, m) in eligible if d not in cand_set), key=lambda x: x[1].get("hits",0)
+    )
+    prefetch_cname_chains([d for d, _ in rem], CFG.cname_max_depth)
     for d, m in rem:
         sus, reasons = cname_suspicious(d, CFG)
         if sus:
             cheap_flags[d] = reasons
             candidates.append((d, m))
+            cand_set.add(d)
 
     # 5) Quarantine update with SCORE & REASON
     now = now_ts()
-    for d, m in candidates:
+    changed = set()
+    scores = compute_scores(candidates, cheap_flags, CFG)
+    for (d, m), score in zip(candidates, scores):
         rlist = cheap_flags.get(d, [])
-        score = compute_score(d, m, rlist, CFG)
-        entry = quarantine.get(d, {}) if isinstance(quarantine, dict) else {}
+        entry = quarantine.get(d, {})
         entry.setdefault("first_seen", now)
         entry["last_seen"] = now
         entry["score"] = float(score)
@@ -556,72 +1059,60 @@ def main():
         entry["uniq"] = int(m.get("uniq",0))
         entry["hours"] = int(m.get("hours",0))
         quarantine[d] = entry
+        changed.add(d)
 
     # 6) Promotion
-    promoted = []
-    dry = CFG.get("dry_run", False)
-    promo_min_score = float(CFG.get("promotion_min_score", 0.90))
-    for d, meta in list(quarantine.items()):
-        # Backward-compat upgrades
-        meta["score"] = float(meta.get("score", 0.0))
-        meta["reason"] = meta.get("reason", "")
-
-        age_hours = (now - meta.get("first_seen", now)) / 3600.0
-        still_candidate = d in dict(candidates)
-        if age_hours >= q_hours and still_candidate and meta.get("score",0.0) >= promo_min_score:
-            if not is_already_blocked_anywhere(d):
+    to_promote = {}
+    dry_log = []
+    dry = CFG.dry_run
+    promo_min_score = CFG.promotion_min_score
+    to_drop = set()
+    # Age/staleness cut-offs as timestamps, computed once rather than per entry
+    mature_before = now - q_hours * 3600
+    stale_before = now - 3 * lookback * 3600
+    for d, meta in quarantine.items():
+        still_candidate = d in cand_set
+        if still_candidate and meta.get("first_seen", now) <= mature_before and meta.get("score",0.0) >= promo_min_score:
+            if not is_blocked(d, blocked, blocked_re):
                 if dry:
-                    log(CFG.get("log_file"), f"[DRYRUN] Would promote: {d} score={meta.get('score'):.3f}")
+                    dry_log.append(f"[DRYRUN] Would promote: {d} score={meta.get('score'):.3f}")
                 else:
-                    if add_to_blacklist(d, CFG):
-                        promoted.append(d)
-                        state.setdefault("blocked", []).append({"domain": d, "ts": now, "score": meta.get("score",0.0)})
-            quarantine.pop(d, None)
-        elif (now - meta.get("last_seen", now)) > (3 * lookback * 3600):
-            quarantine.pop(d, None)  # stale
-
-    # Save main state & caches
-    save_json(quar_path, quarantine)
-    save_json(state_path, state)
+                    to_promote[d] = meta.get("score",0.0)
+            to_drop.add(d)
+        elif meta.get("last_seen", now) < stale_before:
+            to_drop.add(d)  # stale
+    if to_drop:
+        quarantine = {k: v for k, v in quarantine.items() if k not in to_drop}
+
+    log_lines(CFG.log_file, dry_log)
+    promoted = add_to_blacklist(gravity, list(to_promote), CFG)
+    for d in promoted:
+        state.setdefault("blocked", []).append({"domain": d, "ts": now, "score": to_promote[d]})
+
+    # Save quarantine & caches
+    save_quarantine(qconn, quarantine, changed - to_drop, to_drop)
+    qconn.close()
     save_persist_cache(CFG)
 
-    # ---- Review exports (JSON array + TSV) ----
-    try:
-        items = [
-            {
-                "domain": d,
-                "score": float(v.get("score",0.0)),
-                "reason": v.get("reason", ""),
-                "first_seen": int(v.get("first_seen", now)),
-                "last_seen": int(v.get("last_seen", now)),
-                "hits": int(v.get("hits", 0)),
-                "uniq": int(v.get("uniq", 0)),
-                "hours": int(v.get("hours", 0))
-            }
-            for d, v in quarantine.items()
-        ]
-        items.sort(key=lambda x: x.get("score",0.0), reverse=True)
-        save_json(review_json, items)
-        # TSV
-        lines = ["domain	score	reason	first_seen	last_seen	hits	uniq	hours"]
-        for it in items:
-            lines.append(
-                f"{it['domain']}	{it['score']:.3f}	{it['reason']}	{it['first_seen']}	{it['last_seen']}	{it['hits']}	{it['uniq']}	{it['hours']}"
-            )
-        Path(review_tsv).parent.mkdir(parents=True, exist_ok=True)
-        Path(review_tsv).write_text("".join(lines) + "")
-        
-    except Exception as e:
-        log(CFG.get("log_file"), f"Failed to write review exports: {e}")
+    # ---- Review exports (JSON array + TSV), only when the quarantine changed ----
+    if changed or to_drop or not (Path(review_json).exists() and Path(review_tsv).exists()):
+        try:
+            write_review_exports(quarantine, review_json, review_tsv, now)
+        except Exception as e:
+            log(CFG.log_file, f"Failed to write review exports: {e}")
 
-    # ---- Always (re)write adlist output file ----
-    write_output_list(CFG)
+    # ---- Adlist output file (rewritten only when its content changes) + state ----
+    write_output_list(CFG, gravity, state)
+    save_json(state_path, state)
+    for conn in (ftl, gravity):
+        if conn is not None:
+            conn.close()
 
     msg = (
         f"Scan complete. Eligible: {len(eligible)}. New/updated quarantined: {len(candidates)}. "
         f"Promoted to blacklist: {len(promoted)}."
     )
-    log(CFG.get("log_file"), msg)
+    log(CFG.log_file, msg)
     write_metrics(CFG, len(candidates), len(promoted))
     print(msg)
 